@@ -0,0 +1,207 @@
+# ==========================================
+# BENCHMARK DE MEMÓRIA - RERUN DO PAINEL
+# ==========================================
+# Mede pico de RSS e pico de alocações (tracemalloc) de UM cálculo completo
+# do painel (pipeline_cte.computar_painel) com CT-es sintéticos, nos dois modos:
+#   - "copias":     DataFrame dos status não cancelados, Status_Normalizado + filtro (cópia
+#                   do frame), Data_Ref como objetos `date` e .copy() dos recortes de mês
+#   - "sem_copias": filtro na lista, colunas derivadas in-place, Data_Ref em datetime64,
+#                   agrupamento por máscara
+#
+# Uso:
+#   python benchmarks/benchmark_memoria.py                  # compara com a baseline
+#   python benchmarks/benchmark_memoria.py --atualizar      # grava nova baseline
+#   python benchmarks/benchmark_memoria.py --tamanhos 10000 100000
+#
+# Sai com código 1 se algum pico passar da baseline + tolerância, se os dois
+# modos divergirem nos números, ou se o modo sem cópias economizar menos que
+# --economia-min do pico de alocações do modo com cópias.
+
+import argparse
+import gc
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+from pipeline_cte import computar_painel  # noqa: E402
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline_memoria.json")
+TAMANHOS = [10_000, 100_000, 500_000]
+MODOS = ["copias", "sem_copias"]
+HOJE = date(2025, 10, 15)  # Fixo para o resultado ser reprodutível
+MB = 1024 * 1024
+
+
+# ------------------------------------------
+# DADOS SINTÉTICOS (mesmo formato do parse_cte_xml + Status_API)
+# ------------------------------------------
+def gerar_registros(n, semente=42):
+    rng = np.random.default_rng(semente)
+    fim = pd.Timestamp(HOJE) + pd.Timedelta(hours=18)
+    emissao = fim - pd.to_timedelta(rng.integers(0, 365 * 24 * 60, n), unit="m")
+    lag = pd.to_timedelta(rng.integers(1, 180, n), unit="m")
+    status = rng.choice(["authorized", "canceled", "denied", "pending"], n, p=[0.85, 0.07, 0.03, 0.05])
+    sem_protocolo = rng.random(n) < 0.02
+    filiais = [f"Filial {i:02d}" for i in range(50)]
+    pagadores = [f"Cliente {i:05d}" for i in range(max(50, n // 20))]
+    filial_idx = rng.integers(0, len(filiais), n)
+    pagador_idx = rng.integers(0, len(pagadores), n)
+    valores = np.round(rng.gamma(2.0, 900.0, n), 2)
+
+    registros = []
+    for i, (dh, dl) in enumerate(zip(emissao, lag)):
+        st_ = str(status[i])
+        registros.append({
+            "Numero_CTe": str(100000 + i),
+            "Data_Emissao": dh,
+            "Data_Transmissao": None if (sem_protocolo[i] or st_ != "authorized") else dh + dl,
+            "Pagador": pagadores[pagador_idx[i]],
+            "Filial": filiais[filial_idx[i]],
+            "Valor_Total_Frete": float(valores[i]),
+            "Status_API": st_,
+        })
+    return registros
+
+
+# ------------------------------------------
+# MEDIÇÃO (processo filho: um tamanho x um modo)
+# ------------------------------------------
+def _ler_status_kb(campo):
+    with open("/proc/self/status") as f:
+        for linha in f:
+            if linha.startswith(campo + ":"):
+                return int(linha.split()[1])
+    return None
+
+def _zerar_pico_rss():
+    """Zera o VmHWM (Linux). Retorna False se não for possível (usa ru_maxrss)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def medir(n, modo):
+    sem_copias = modo == "sem_copias"
+    registros = gerar_registros(n)
+    gc.collect()
+
+    # 1) Pico de RSS (sem tracemalloc ligado, para não inflar o processo)
+    zerou = _zerar_pico_rss()
+    rss_base_kb = _ler_status_kb("VmRSS") if zerou else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t0 = time.perf_counter()
+    resultado = computar_painel(registros, HOJE, sem_copias=sem_copias)
+    tempo = time.perf_counter() - t0
+    pico_kb = _ler_status_kb("VmHWM") if zerou else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    del resultado
+    gc.collect()
+
+    # 2) Pico de alocações Python/NumPy (tracemalloc)
+    tracemalloc.start()
+    resultado = computar_painel(registros, HOJE, sem_copias=sem_copias)
+    _, pico_trace = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "pico_rss_mb": round(max(0, pico_kb - rss_base_kb) / 1024, 1),
+        "pico_tracemalloc_mb": round(pico_trace / MB, 1),
+        "pico_tracemalloc_bytes": pico_trace,
+        "tempo_s": round(tempo, 2),
+        "rss_exato": zerou,
+        "resultado": resultado,
+    }
+
+def medir_em_subprocesso(n, modo):
+    # Processo novo por medição: o pico de RSS de uma não contamina a outra
+    saida = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--filho", str(n), modo],
+        check=True, capture_output=True, text=True
+    )
+    return json.loads(saida.stdout.strip().splitlines()[-1])
+
+
+# ------------------------------------------
+# SUÍTE
+# ------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de memória do rerun do painel.")
+    parser.add_argument("--tamanhos", type=int, nargs="+", default=TAMANHOS)
+    parser.add_argument("--atualizar", action="store_true", help="Grava os resultados como nova baseline.")
+    parser.add_argument("--tolerancia", type=float, default=0.15, help="Aumento relativo aceito sobre a baseline.")
+    parser.add_argument("--folga-mb", type=float, default=5.0, help="Folga absoluta (ruído em tamanhos pequenos).")
+    parser.add_argument("--economia-min", type=float, default=0.05,
+                        help="Economia relativa mínima do modo sem cópias (fração do pico com cópias).")
+    parser.add_argument("--filho", nargs=2, metavar=("N", "MODO"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.filho:
+        print(json.dumps(medir(int(args.filho[0]), args.filho[1]), default=str))
+        return 0
+
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+
+    falhas = []
+    novos = {}
+    print(f"{'CT-es':>8} {'modo':>11} {'pico RSS':>10} {'tracemalloc':>12} {'tempo':>7}   baseline (RSS / trace)")
+    for n in args.tamanhos:
+        medidas = {}
+        for modo in MODOS:
+            m = medir_em_subprocesso(n, modo)
+            medidas[modo] = m
+            base = baseline.get(str(n), {}).get(modo)
+            ref = f"{base['pico_rss_mb']:.1f} / {base['pico_tracemalloc_mb']:.1f} MB" if base else "-"
+            print(f"{n:>8} {modo:>11} {m['pico_rss_mb']:>7.1f} MB {m['pico_tracemalloc_mb']:>9.1f} MB {m['tempo_s']:>6.2f}s   {ref}")
+
+            if base and not args.atualizar:
+                for chave in ("pico_rss_mb", "pico_tracemalloc_mb"):
+                    limite = base[chave] * (1 + args.tolerancia) + args.folga_mb
+                    if m[chave] > limite:
+                        falhas.append(f"{n} {modo}: {chave} {m[chave]:.1f} MB > limite {limite:.1f} MB")
+
+        # Os dois modos precisam dar os mesmos números no painel
+        if medidas["copias"]["resultado"] != medidas["sem_copias"]["resultado"]:
+            falhas.append(f"{n}: resultados divergem entre os modos")
+
+        # E o modo sem cópias precisa economizar pelo menos --economia-min
+        pico_copias = medidas["copias"]["pico_tracemalloc_bytes"]
+        economia = pico_copias - medidas["sem_copias"]["pico_tracemalloc_bytes"]
+        relativa = economia / pico_copias if pico_copias else 0.0
+        print(f"{'':>8} {'economia':>11} {economia / MB:>23.1f} MB ({relativa:.1%})")
+        if relativa < args.economia_min:
+            falhas.append(f"{n}: modo sem cópias economizou {relativa:.1%} do pico de alocações "
+                          f"(mínimo {args.economia_min:.0%})")
+
+        novos[str(n)] = {
+            modo: {k: medidas[modo][k] for k in ("pico_rss_mb", "pico_tracemalloc_mb", "tempo_s")}
+            for modo in MODOS
+        }
+
+    if args.atualizar:
+        baseline.update(novos)
+        with open(BASELINE, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Baseline gravada em {BASELINE}")
+
+    for falha in falhas:
+        print("FALHA:", falha)
+    return 1 if falhas else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
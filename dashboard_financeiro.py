@@ -7,11 +7,21 @@ import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 from datetime import datetime, timedelta, timezone
-import requests
-import xml.etree.ElementTree as ET
-import re
 import time
 import numpy as np
+import cProfile
+import pstats
+import marshal
+import io
+import uuid
+import threading
+from collections import deque
+import pipeline_cte
+from pipeline_cte import (
+    StatsManager, STATUS_EXCLUIDOS, PENDENTES_POLL_SECONDS, FORECAST_SEMANAS,
+    montar_df, agrupar_comparativo, soma_periodo, buscar_ctes,
+    serie_tendencia, RESOLUCOES, TENDENCIA_MAX_PONTOS,
+)
 from streamlit_autorefresh import st_autorefresh
 
 
@@ -25,6 +35,89 @@ st.set_page_config(
 )
 
 AUTO_REFRESH_SECONDS = 900  # 15 minutos
+PERFIS_GUARDADOS = 5  # Capturas do profiler mantidas para comparação
+PERFIL_MAX_SEGUNDOS = 300  # Captura aberta há mais que isso foi abandonada (libera a vaga)
+BUSCA_PAGINA = 50   # Linhas por página na busca de CT-es
+
+# ------------------------------------------
+# PROFILER SOB DEMANDA (captura a execução inteira do script)
+# ------------------------------------------
+@st.cache_resource
+def get_perfis():
+    # Compartilhado entre sessões: últimas capturas para comparar regressões
+    return deque(maxlen=PERFIS_GUARDADOS)
+
+@st.cache_resource
+def get_captura():
+    # Uma captura por vez no servidor: no Python >= 3.12 o cProfile usa sys.monitoring,
+    # que é global, e um segundo enable() falha com ValueError
+    return {"lock": threading.Lock(), "ativa": None}
+
+def iniciar_perfil():
+    """Liga o profiler para esta execução. Retorna False se já houver captura em andamento."""
+    captura = get_captura()
+    with captura["lock"]:
+        ativa = captura["ativa"]
+        if ativa is not None:
+            profiler, inicio = ativa
+            if time.perf_counter() - inicio < PERFIL_MAX_SEGUNDOS:
+                return False
+            profiler.disable()  # Sessão que abriu a captura não voltou para fechá-la
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:  # Outra ferramenta de profiling ativa no processo
+            captura["ativa"] = None
+            return False
+        captura["ativa"] = (profiler, time.perf_counter())
+        st.session_state["perfil_ativo"] = captura["ativa"]
+    return True
+
+def _area_da_funcao(arquivo):
+    if arquivo == "~":
+        return "builtins"
+    for area in ("pandas", "numpy", "plotly", "streamlit", "requests", "xml"):
+        if area in arquivo:
+            return area
+    return "dashboard" if arquivo.endswith(("dashboard_financeiro.py", "pipeline_cte.py")) else "outros"
+
+def finalizar_perfil(n_ctes=0, n_linhas=0, interrompida=False):
+    """
+    Encerra a captura (se houver) e guarda o resultado. Pode ser chamada mais de uma vez.
+    Chamar antes de todo st.rerun(): o rerun interrompe o script e a captura ficaria aberta.
+    """
+    perfil = st.session_state.pop("perfil_ativo", None)
+    if perfil is None:
+        return
+    profiler, inicio = perfil
+    profiler.disable()
+    captura = get_captura()
+    with captura["lock"]:
+        if captura["ativa"] is perfil:
+            captura["ativa"] = None
+
+    stats = pstats.Stats(profiler, stream=io.StringIO())
+    stats.sort_stats("cumulative").print_stats(40)
+
+    # Tempo próprio (tottime) somado por biblioteca
+    por_area = {}
+    for (arquivo, _, _), (_, _, tottime, _, _) in stats.stats.items():
+        area = _area_da_funcao(arquivo)
+        por_area[area] = por_area.get(area, 0.0) + tottime
+
+    get_perfis().appendleft({
+        "Quando": datetime.now(),
+        "Duracao_s": None if interrompida else time.perf_counter() - inicio,
+        "CT-es": n_ctes,
+        "Linhas_DF": n_linhas,
+        "por_area": por_area,
+        "texto": stats.stream.getvalue(),
+        "prof": marshal.dumps(stats.stats),  # Mesmo formato do dump_stats (snakeviz / flameprof)
+    })
+
+# Captura que ficou aberta: a execução anterior terminou em exceção antes de fechá-la
+finalizar_perfil(interrompida=True)
+captura_recusada = st.session_state.pop("perfilar_proxima", False) and not iniciar_perfil()
 
 # Componente de Auto-Refresh (Mantém o painel vivo)
 count = st_autorefresh(interval=AUTO_REFRESH_SECONDS * 1000, key="fancylostcounter")
@@ -75,13 +168,55 @@ if "last_auto_refresh" in st.session_state:
 
 if st.sidebar.button("🔄 Forçar Atualização Agora"):
     st.cache_data.clear()
+    finalizar_perfil()
     st.rerun()
 
+with st.sidebar.expander("⏱️ Profiler", expanded=False):
+    if st.button("Perfilar próxima execução"):
+        st.session_state["perfilar_proxima"] = True
+        finalizar_perfil()
+        st.rerun()
+    if captura_recusada:
+        st.warning("Já existe uma captura em andamento (outra sessão). Tente de novo em instantes.")
+
+    perfis = list(get_perfis())
+    if perfis:
+        st.dataframe(
+            pd.DataFrame([
+                {"Quando": p["Quando"].strftime("%d/%m %H:%M:%S"),
+                 "Duração (s)": round(p["Duracao_s"], 2) if p["Duracao_s"] is not None else None,
+                 "CT-es": p["CT-es"], "Linhas": p["Linhas_DF"], "Completa": p["Duracao_s"] is not None}
+                for p in perfis
+            ]),
+            hide_index=True
+        )
+        idx_perfil = st.selectbox(
+            "Captura", range(len(perfis)),
+            format_func=lambda i: perfis[i]["Quando"].strftime("%d/%m %H:%M:%S")
+        )
+        perfil = perfis[idx_perfil]
+        st.dataframe(
+            pd.DataFrame(sorted(perfil["por_area"].items(), key=lambda x: -x[1]), columns=["Área", "Tempo (s)"]),
+            hide_index=True
+        )
+        st.download_button(
+            "⬇️ Baixar .prof",
+            data=perfil["prof"],
+            file_name=f"painel_{perfil['Quando']:%Y%m%d_%H%M%S}.prof",
+            mime="application/octet-stream"
+        )
+        st.caption("Abra com `snakeviz` ou `flameprof` para ver o flamegraph.")
+        st.code(perfil["texto"], language=None)
+    else:
+        st.caption("Nenhuma captura ainda.")
+
 SUBDOMAIN = st.sidebar.text_input("Subdomínio", value="trf")
 TOKEN = st.sidebar.text_input("Token", value="7f-z3i1jYgura6oQBDKdeDxu2jBMqwAH2jFRjbGd2JJz9CBUWENQYA", type="password")
-DAYS_BACK = st.sidebar.slider("Buscar últimos (dias)", 30, 365, 120)
+DAYS_BACK = st.sidebar.slider("Buscar últimos (dias)", 30, 730, 120)
 
 CONNECT_API = st.sidebar.checkbox("Conectar à API", value=True)
+SEM_COPIAS = st.sidebar.checkbox("Modo econômico de memória", value=True,
+                                 help="Monta o DataFrame sem cópias intermediárias (mesmos números).")
 
 # ------------------------------------------
 # CÁLCULO DO PERÍODO (FORA DO CACHE)
@@ -92,206 +227,19 @@ fuso_br = timezone(timedelta(hours=-3))
 since_dt = datetime.now(fuso_br) - timedelta(days=DAYS_BACK)
 
 # ------------------------------------------
-# FUNÇÃO: LER XML DO CT-e
+# CACHE DOS ÍNDICES (chave = StatsManager.chave_cache(); o DataFrame não é hasheado)
 # ------------------------------------------
-def parse_cte_xml(xml_string):
-    try:
-        if not xml_string: return None
-
-        # Limpeza
-        xml_string = re.sub(r'xmlns[^=]*="[^"]*"', '', xml_string)
-        xml_string = re.sub(r'(<\/?)\w+:', r'\1', xml_string)
-
-        root = ET.fromstring(xml_string)
-        inf = root.find(".//infCte")
-        if inf is None: return None
-
-        ide = inf.find("ide")
-        numero = ide.findtext("nCT", default="S/N")
-        dh_emi = ide.findtext("dhEmi")
-
-        # Data com Fuso
-        data = pd.to_datetime(dh_emi, errors="coerce")
-        if data is not None:
-            # Garante remoção de TZ para comparar com datas locais
-            data = data.replace(tzinfo=None)
-
-        valor = float(inf.findtext(".//vTPrest", default="0"))
-        pagador = inf.findtext(".//rem/xNome", default="Cliente Diverso")
-        
-        # Extração de Filial (Emitente)
-        xFant = inf.findtext(".//emit/xFant")
-        xNome = inf.findtext(".//emit/xNome")
-        filial = xFant if xFant else (xNome if xNome else "Matriz")
-
-        # Data de Transmissão (Protocolo)
-        prot = root.find(".//protCTe")
-        data_transmissao = None
-        if prot:
-            infProt = prot.find("infProt")
-            if infProt is not None:
-                dh_recbto = infProt.findtext("dhRecbto")
-                if dh_recbto:
-                    dt_trans = pd.to_datetime(dh_recbto, errors="coerce")
-                    if dt_trans is not None:
-                        data_transmissao = dt_trans.replace(tzinfo=None)
-
-        return {
-            "Numero_CTe": numero,
-            "Data_Emissao": data,
-            "Data_Transmissao": data_transmissao,
-            "Pagador": pagador,
-            "Filial": filial,
-            "Valor_Total_Frete": valor
-        }
-    except Exception:
-        return None
-
-
-# ------------------------------------------
-# FUNÇÃO: BUSCAR DADOS (INCREMENTAL)
-# ------------------------------------------
-# Removido cache_data para gerenciar manualmente no session_state
-# FUNÇÃO: BUSCAR DADOS (PAGINADO COM CURSOR)
-# ------------------------------------------
-def fetch_batch(token, subdomain, start_param):
-    """
-    Busca UM ou ALGUNS lotes de dados.
-    start_param: pode ser {"since": "..."} ou {"start": "NEXT_ID"}
-    Retorna: (lista_items, proximo_cursor_str ou None)
-    """
-    base_url = f"https://{subdomain}.eslcloud.com.br/api/ctes"
-    headers = {"Authorization": f"Token {token}"}
-    
-    # Adiciona limite padrão
-    params = start_param.copy()
-    params["limit"] = 100 
-    
-    try:
-        r = requests.get(base_url, headers=headers, params=params, timeout=15)
-        if r.status_code != 200:
-            return [], None
-        payload = r.json()
-    except:
-        return [], None
-        
-    items = payload.get("data", [])
-    next_id = payload.get("paging", {}).get("next_id")
-    
-    return items, next_id
-
-# ------------------------------------------
-# GERENCIADOR DE DADOS GLOBAL (Persiste no F5)
-# ------------------------------------------
-@st.cache_resource
-class StatsManager:
-    def __init__(self):
-        self.cte_storage = {}
-        self.last_days_back = 0
-        self.last_sync_time = None
-        
-        # Estado de sincronização contínua
-        self.resume_token = None # Se diferente de None, indica que tem mais páginas
-        self.is_syncing = False # Flag visual
-        self.current_params = {} # Armazena os parâmetros da última requisição para continuar
-
-    def get_all(self):
-        return list(self.cte_storage.values())
-        
-    def sync_step(self, token, subdomain, days_back, time_limit=2.0):
-        """
-        Executa passos de sincronização por no máximo `time_limit` segundos.
-        Retorna (novos_items_count, continua_proxima_run?)
-        """
-        fuso_br = timezone(timedelta(hours=-3))
-        agora = datetime.now(fuso_br)
-        start_time = time.time()
-        
-        # 1. Detectar necessidade de Full Reload (Resetar cursor)
-        if days_back > self.last_days_back:
-            # User pediu mais dias, resetamos para buscar tudo desde o novo 'since'
-            self.last_days_back = days_back
-            self.resume_token = None
-            
-            since = (agora - timedelta(days=days_back)).strftime("%Y-%m-%dT%H:%M:%S.000-03:00")
-            self.current_params = {"since": since}
-            
-        elif not self.cte_storage and not self.resume_token:
-             # Cache vazio (primeiro load) e não estamos no meio de uma sync
-            self.last_days_back = days_back
-            self.resume_token = None
-            since = (agora - timedelta(days=days_back)).strftime("%Y-%m-%dT%H:%M:%S.000-03:00")
-            self.current_params = {"since": since}
-
-        elif self.resume_token is None:
-            # Incremental (só os últimos 7 dias)
-            # Iniciamos um novo ciclo incremental se não houver um em andamento
-            start_date = agora - timedelta(days=7)
-            since = start_date.strftime("%Y-%m-%dT%H:%M:%S.000-03:00")
-            self.current_params = {"since": since}
-        
-        # Se resume_token já tem next_id (continuação), usamos ele
-        if self.resume_token:
-            self.current_params = {"start": self.resume_token}
-            
-        count_new_session = 0
-        has_more = False
-        
-        # Loop pequeno (Time Boxed)
-        while True:
-            # Verifica tempo
-            if (time.time() - start_time) > time_limit:
-                 has_more = True
-                 break
-            
-            items, next_id = fetch_batch(token, subdomain, self.current_params)
-            
-            if not items:
-                # Fim da linha para este batch
-                if not next_id:
-                    self.resume_token = None # Fim total
-                    has_more = False
-                    break
-            
-            # Processar Itens
-            for item in items:
-                try:
-                    cte_data = item.get("cte", item)
-                    item_id = cte_data.get("id") or item.get("id")
-                    
-                    if not item_id:
-                        xml_c = cte_data.get("xml") or cte_data.get("content")
-                        if xml_c:
-                            parsed = parse_cte_xml(xml_c)
-                            if parsed: item_id = parsed.get("Numero_CTe")
-                    
-                    if item_id:
-                        if item_id not in self.cte_storage:
-                            count_new_session += 1
-                        self.cte_storage[item_id] = item
-                    else:
-                        # Hash fallback
-                        xml_c = cte_data.get("xml") or cte_data.get("content")
-                        if xml_c:
-                            h = str(hash(xml_c))
-                            if h not in self.cte_storage: count_new_session += 1
-                            self.cte_storage[h] = item
-                except:
-                    pass
-            
-            # Preparar próxima página
-            if next_id:
-                self.resume_token = next_id
-                self.current_params = {"start": next_id}
-                has_more = True # Tem mais, mas vamos ver se dá tempo de pegar no proximo loop
-            else:
-                self.resume_token = None
-                has_more = False
-                break
-        
-        self.last_sync_time = datetime.now()
-        self.is_syncing = has_more
-        return count_new_session, has_more
+# DataFrame do painel: só muda quando a base muda; compartilhado entre sessões e
+# só lido pelo script -> cache_resource (sem montar nem unpickle a cada rerun)
+@st.cache_resource(show_spinner=False, max_entries=4)
+def df_painel(_mgr, chave, sem_copias):
+    return montar_df(_mgr.get_registros(), sem_copias=sem_copias)
+
+projetar_faturamento = st.cache_data(show_spinner=False, max_entries=4)(pipeline_cte.projetar_faturamento)
+indice_periodos = st.cache_data(show_spinner=False, max_entries=4)(pipeline_cte.indice_periodos)
+# Índice de busca: objeto grande e só lido -> cache_resource (sem unpickle a cada rerun)
+indice_busca = st.cache_resource(show_spinner=False, max_entries=2)(pipeline_cte.indice_busca)
+agregados_tendencia = st.cache_data(show_spinner=False, max_entries=2)(pipeline_cte.agregados_tendencia)
 
 @st.cache_resource
 def get_manager():
@@ -304,9 +252,42 @@ def get_manager():
         mgr.resume_token = None
     if not hasattr(mgr, "current_params"): 
         mgr.current_params = {}
+    if not hasattr(mgr, "geracao"):
+        mgr.geracao = uuid.uuid4().hex
+    if not hasattr(mgr, "_lock"):
+        mgr._lock = threading.RLock()
+    if not hasattr(mgr, "chave_por_digest"):
+        mgr._reiniciar_indices()
     return mgr
 
 
+# ------------------------------------------
+# PAINEL: NÃO TRANSMITIDOS (Fragmento com cadência própria)
+# ------------------------------------------
+@st.fragment(run_every=PENDENTES_POLL_SECONDS)
+def painel_pendentes(mgr):
+    # Re-consulta só os pendentes; se algum mudou, atualiza o painel inteiro
+    if mgr.poll_pendentes(TOKEN, SUBDOMAIN):
+        finalizar_perfil(len(mgr.cte_storage))
+        st.rerun(scope="app")
+    
+    # Contagem e valor mantidos pelo StatsManager (sem varrer o DataFrame)
+    qtd_pendente, val_pendente = mgr.get_resumo_pendentes()
+    
+    if qtd_pendente > 0:
+        st.warning(f"⚠️ **Atenção:** Existem **{qtd_pendente} CT-es** detectados como **Não Transmitidos** (R$ {val_pendente:,.2f}).")
+        with st.expander("Ver CT-es Não Transmitidos"):
+            df_pendentes = pd.DataFrame(
+                mgr.get_pendentes(),
+                columns=["Numero_CTe", "Data_Emissao", "Status_API", "Valor_Total_Frete"]
+            ).sort_values("Data_Emissao", ascending=False)
+            st.dataframe(
+                df_pendentes
+                .style.format({"Valor_Total_Frete": "R$ {:,.2f}", "Data_Emissao": "{:%d/%m %H:%M}"}),
+                use_container_width=True
+            )
+
+
 # ------------------------------------------
 # DASHBOARD
 # ------------------------------------------
@@ -328,35 +309,57 @@ if CONNECT_API and TOKEN:
     # Botão de Reset GLOBAL
     if st.sidebar.button("🗑️ Resetar Tudo (Global)"):
         st.cache_resource.clear()
+        st.cache_data.clear()
+        finalizar_perfil()
         st.rerun()
 
     # 2. RENDERIZA DASHBOARD COM O QUE TEM (Para não travar visualização)
     # (A lógica continua abaixo com a variável 'items')
     
-    records = []
-    for item in items:
-        cte = item.get("cte", item)
-        if cte.get("status") in ["canceled", "denied"]:
-            continue
-            
-        xml = cte.get("xml") or cte.get("content")
-        parsed = parse_cte_xml(xml)
-        if parsed:
-            parsed["Status_API"] = cte.get("status", "unknown")
-            records.append(parsed)
-            
-    df = pd.DataFrame(records)
+    # Registros já parseados na ingestão (CDC) - não re-lemos XML a cada rerun
+    # O DataFrame já sai só com os autorizados, com Data_Ref e Lag_Minutos,
+    # e só é remontado quando a chave do gerenciador muda
+    df = df_painel(mgr, mgr.chave_cache(), SEM_COPIAS)
 
     # --- DIAGNÓSTICO DE STATUS (SIDEBAR) ---
     with st.sidebar.expander("📊 Diagnóstico de Status (Raw)", expanded=False):
-        if not df.empty and "Status_API" in df.columns:
-            status_counts = df["Status_API"].value_counts().reset_index()
-            status_counts.columns = ["Status", "Qtd"]
-            st.write("Total Carregado:", len(df))
+        status_counts = pd.DataFrame(
+            [(status, qtd) for status, (qtd, _) in mgr.get_resumo_status().items() if status not in STATUS_EXCLUIDOS],
+            columns=["Status", "Qtd"]
+        ).sort_values("Qtd", ascending=False)
+        if not status_counts.empty:
+            st.write("Total Carregado:", int(status_counts["Qtd"].sum()))
             st.dataframe(status_counts, hide_index=True)
         else:
             st.warning("Nenhum dado processado (DataFrame vazio).")
 
+    # --- QUARENTENA DE XML (SIDEBAR) ---
+    falhas_xml = mgr.get_quarentena()
+    qtd_quarentena = len(falhas_xml)
+    with st.sidebar.expander(f"🧪 Quarentena de XML ({qtd_quarentena})", expanded=False):
+        if qtd_quarentena:
+            quarentena = pd.DataFrame(falhas_xml).drop(columns=["Digest"])
+            st.warning(f"{qtd_quarentena} CT-es não puderam ser lidos e estão fora dos totais.")
+            motivos = quarentena.groupby("Motivo").size().reset_index(name="Qtd").sort_values("Qtd", ascending=False)
+            st.dataframe(motivos, hide_index=True)
+            quarentena["Desde"] = quarentena["Desde"].dt.strftime("%d/%m %H:%M")
+            st.dataframe(quarentena.sort_values("Ocorrencias", ascending=False).head(50), hide_index=True)
+            st.caption("Só são re-lidos quando o conteúdo do XML mudar.")
+        else:
+            st.caption("Nenhum XML com falha de leitura.")
+
+    # --- FEED DE TRANSIÇÕES (SIDEBAR) ---
+    with st.sidebar.expander("🔔 Transições Recentes", expanded=False):
+        transicoes = mgr.get_transicoes(20)
+        if transicoes:
+            feed = pd.DataFrame(transicoes)
+            feed["Quando"] = feed["Quando"].dt.strftime("%d/%m %H:%M")
+            feed["De"] = feed["De"].astype(str)
+            feed["Para"] = feed["Para"].astype(str)
+            st.dataframe(feed, hide_index=True)
+        else:
+            st.caption("Nenhuma mudança de status desde o início da sessão.")
+
 else:
     df = pd.DataFrame()
 
@@ -377,86 +380,34 @@ if not df.empty:
     hoje_mp_date = hoje_mes_passado.date()
     ontem_mp_date = ontem_mes_passado.date()
 
-    df = pd.DataFrame(records)
-    
     # --- SIMULAÇÃO DE CENÁRIOS (DEBUG) ---
     # Vamos calcular quanto daria se incluíssemos TUDO (cancelados, denegados, etc)
-    # Re-processar lista crua sem filtros
-    all_records = []
-    for item in items:
-        cte = item.get("cte", item)
-        # SEM FILTRO DE STATUS
-        xml = cte.get("xml") or cte.get("content")
-        parsed = parse_cte_xml(xml)
-        if parsed:
-            # Adiciona o status ao objeto para agrupar
-            parsed["Status"] = cte.get("status", "unknown")
-            all_records.append(parsed)
-    
-    df_all = pd.DataFrame(all_records)
+    # O resumo por status é mantido incrementalmente pelo StatsManager (sem reprocessar a lista crua)
+    resumo = pd.DataFrame(
+        [(status, qtd, valor) for status, (qtd, valor) in mgr.get_resumo_status().items()],
+        columns=["Status", "Qtd", "Valor"]
+    )
     
-    if not df_all.empty:
-        df_all["Data_Ref"] = df_all["Data_Emissao"].dt.date
-        
-        # Filtro Novembro (Hardcoded para teste rápido ou dinâmico)
-        # User disse "Novembro", então vamos filtrar mês 11/2025 (ou ano atual)
-        # Mas melhor mostrar o GERAL dos dados baixados (que é 60 dias)
-        
+    if not resumo.empty:
         with st.sidebar.expander("🕵️‍♂️ Comparativo de Status (Simulação)", expanded=True):
             st.write("Se considerarmos **TODOS** os status:")
             
-            # Agrupa por Status
-            resumo = df_all.groupby("Status").agg(
-                Qtd=("Numero_CTe", "count"),
-                Valor=("Valor_Total_Frete", "sum")
-            ).reset_index()
-            
             st.dataframe(resumo.style.format({"Valor": "R$ {:,.2f}"}), hide_index=True)
             
-            total_qtd = df_all["Numero_CTe"].count()
-            total_val = df_all["Valor_Total_Frete"].sum()
+            total_qtd = resumo["Qtd"].sum()
+            total_val = resumo["Valor"].sum()
             
             st.caption("Compare esses números com o do seu sistema. Se bater, é porque o sistema conta cancelados!")
 
-    df["Data_Ref"] = df["Data_Emissao"].dt.date
-    
-    # Lógica de Não Transmitido:
-    # 1. Identificar PENDENTES antes de filtrar o DataFrame principal (para o alerta)
-    df_raw = df.copy()
-    
-    # Identificar "Em Processamento / Não Transmitido" (No Raw)
-    df_raw["Nao_Transmitido"] = (
-        (df_raw["Status_API"] != "authorized") | 
-        (df_raw["Data_Transmissao"].isna())
-    )
-    # Ignorar cancelados no alerta de pendente se o user não quiser ver cancelados pendentes (geralmente não quer)
-    df_pendentes = df_raw[
-        (df_raw["Nao_Transmitido"] == True) & 
-        (~df_raw["Status_API"].isin(["canceled", "denied"]))
-    ]
-
-    # --- FILTRO FINAL: APENAS AUTORIZADOS PARA O FINANCEIRO ---
-    # Convertemos para minúsculo para garantir compatibilidade
-    if "Status_API" in df.columns:
-        df["Status_Normalizado"] = df["Status_API"].astype(str).str.lower().str.strip()
-        df = df[df["Status_Normalizado"] == "authorized"]
-
     # --- DEDUPLICAÇÃO INTELIGENTE REMOVIDA TEMPORARIAMENTE ---
     # O filtro por número simples pode ter removido CT-es de Séries diferentes (Ex: Série 1 e 2 com mesmo número).
     # Vamos confiar no ID único da API que o StatsManager já gerencia.
     # if not df.empty:
     #    df = df.drop_duplicates(subset=["Numero_CTe"], keep="last")
-    
-    # Identificar Lag (Atraso na transmissão) em Minutos (Agora só nos autorizados)
-    df["Lag_Minutos"] = (df["Data_Transmissao"] - df["Data_Emissao"]).dt.total_seconds() / 60.0
-    df["Lag_Minutos"] = df["Lag_Minutos"].fillna(0) 
-
-    # --- FILTROS DE DADOS ---
-    df_hoje = df[df["Data_Ref"] == hoje]
-    df_hoje_mp = df[df["Data_Ref"] == hoje_mp_date] 
 
-    df_ontem = df[df["Data_Ref"] == ontem]
-    df_ontem_mp = df[df["Data_Ref"] == ontem_mp_date] # Comparativo
+    # --- ÍNDICE DE PERÍODOS (SOMAS ACUMULADAS) ---
+    # Cada KPI abaixo é uma soma de intervalo em O(1), sem mascarar o DataFrame
+    indice = indice_periodos(df, mgr.chave_cache())
 
     # --- MÉTRICAS E DELTAS ---
     def calc_delta(atual, anterior):
@@ -464,32 +415,24 @@ if not df.empty:
         return ((atual - anterior) / anterior) * 100
 
     # KPI 1: HOJE
-    val_hoje = df_hoje["Valor_Total_Frete"].sum()
-    val_hoje_mp = df_hoje_mp["Valor_Total_Frete"].sum()
+    val_hoje, qtd_hoje = soma_periodo(indice, hoje, hoje)
+    val_hoje_mp, qtd_hoje_mp = soma_periodo(indice, hoje_mp_date, hoje_mp_date)
     delta_val_hoje = calc_delta(val_hoje, val_hoje_mp)
-    
-    qtd_hoje = len(df_hoje)
-    qtd_hoje_mp = len(df_hoje_mp)
     delta_qtd_hoje = calc_delta(qtd_hoje, qtd_hoje_mp)
 
-    val_ontem = df_ontem["Valor_Total_Frete"].sum()
-    val_ontem_mp = df_ontem_mp["Valor_Total_Frete"].sum()
+    val_ontem, _ = soma_periodo(indice, ontem, ontem)
+    val_ontem_mp, _ = soma_periodo(indice, ontem_mp_date, ontem_mp_date) # Comparativo
     delta_val_ontem = calc_delta(val_ontem, val_ontem_mp)
 
     # KPI 3: MÊS ATUAL (Vigente)
     mes_atual_start = hoje.replace(day=1)
-    df_mes_atual = df[df["Data_Ref"] >= mes_atual_start]
-    val_mes_atual = df_mes_atual["Valor_Total_Frete"].sum()
+    val_mes_atual, qtd_mes_atual = soma_periodo(indice, mes_atual_start, hoje)
     
     # KPI 4: MÊS ANTERIOR (FECHADO)
     mes_passado_start = (hoje.replace(day=1) - timedelta(days=1)).replace(day=1)
     mes_passado_end = hoje.replace(day=1) - timedelta(days=1)
     
-    df_mes_passado = df[
-        (df["Data_Ref"] >= mes_passado_start) & 
-        (df["Data_Ref"] <= mes_passado_end)
-    ]
-    val_mes_passado = df_mes_passado["Valor_Total_Frete"].sum()
+    val_mes_passado, qtd_mes_passado = soma_periodo(indice, mes_passado_start, mes_passado_end)
     
     meses_pt = {1:"Janeiro", 2:"Fevereiro", 3:"Março", 4:"Abril", 5:"Maio", 6:"Junho", 
                 7:"Julho", 8:"Agosto", 9:"Setembro", 10:"Outubro", 11:"Novembro", 12:"Dezembro"}
@@ -498,8 +441,7 @@ if not df.empty:
 
     # KPI 5: ANO ATUAL (YTD)
     ano_atual = hoje.year
-    df_ano = df[df["Data_Emissao"].dt.year == ano_atual]
-    val_ano = df_ano["Valor_Total_Frete"].sum()
+    val_ano, qtd_ano = soma_periodo(indice, hoje.replace(month=1, day=1), hoje.replace(month=12, day=31))
 
     # DISPLAY (5 COLUNAS)
     c1, c2, c3, c4, c5 = st.columns(5)
@@ -525,14 +467,14 @@ if not df.empty:
     c3.metric(
         label=f"{nome_mes_atual} (Em Curso)",
         value=f"R$ {fmt_brl(val_mes_atual)}",
-        delta=f"{len(df_mes_atual)} CT-es",
+        delta=f"{qtd_mes_atual} CT-es",
         delta_color="off"
     )
     
     c4.metric(
         label=f"{nome_mes_passado} (Fechado)",
         value=f"R$ {fmt_brl(val_mes_passado)}",
-        delta=f"{len(df_mes_passado)} CT-es",
+        delta=f"{qtd_mes_passado} CT-es",
         delta_color="off"
     )
 
@@ -544,26 +486,69 @@ if not df.empty:
     c5.metric(
         label=f"Ano {ano_atual}",
         value=f"R$ {fmt_brl(val_ano)}",
-        delta=f"{len(df_ano)} CT-es",
+        delta=f"{qtd_ano} CT-es",
         delta_color="off"
     )
 
-    # --- KPI EXTRA: NÃO TRANSMITIDOS ---
+    # --- COMPARAÇÃO DE PERÍODOS (LIVRE / YoY) ---
+    with st.expander("📅 Comparar Períodos", expanded=False):
+        cp_1, cp_2, cp_3 = st.columns([2, 2, 2])
+        with cp_1:
+            periodo_sel = st.date_input(
+                "Período",
+                value=(mes_atual_start, hoje),
+                max_value=hoje,
+                format="DD/MM/YYYY"
+            )
+        with cp_2:
+            modo_comp = st.radio("Comparar com", ["Período anterior", "Ano anterior (YoY)"], horizontal=True)
+        with cp_3:
+            filial_comp = st.selectbox("Filial", ["Todas"] + (indice["filiais"] if indice else []),
+                                       key="comparar_filial")
+
+        if isinstance(periodo_sel, (list, tuple)) and len(periodo_sel) == 2:
+            p_ini, p_fim = periodo_sel
+            n_dias_sel = (p_fim - p_ini).days + 1
+            if modo_comp == "Período anterior":
+                c_fim = p_ini - timedelta(days=1)
+                c_ini = c_fim - timedelta(days=n_dias_sel - 1)
+            else:
+                c_ini = (pd.Timestamp(p_ini) - pd.DateOffset(years=1)).date()
+                c_fim = (pd.Timestamp(p_fim) - pd.DateOffset(years=1)).date()
+
+            filial_arg = None if filial_comp == "Todas" else filial_comp
+            val_sel, qtd_sel = soma_periodo(indice, p_ini, p_fim, filial_arg)
+            val_comp, qtd_comp = soma_periodo(indice, c_ini, c_fim, filial_arg)
+
+            m_1, m_2, m_3 = st.columns(3)
+            m_1.metric(
+                label=f"{p_ini.strftime('%d/%m/%y')} a {p_fim.strftime('%d/%m/%y')}",
+                value=f"R$ {fmt_brl(val_sel)}",
+                delta=f"{calc_delta(val_sel, val_comp):+.1f}%".replace(".", ","),
+                delta_color="normal"
+            )
+            m_2.metric(
+                label=f"{c_ini.strftime('%d/%m/%y')} a {c_fim.strftime('%d/%m/%y')}",
+                value=f"R$ {fmt_brl(val_comp)}",
+                delta=f"{qtd_comp} CT-es",
+                delta_color="off"
+            )
+            m_3.metric(
+                label="CT-es no Período",
+                value=f"{qtd_sel}",
+                delta=f"{calc_delta(qtd_sel, qtd_comp):+.1f}%".replace(".", ","),
+                delta_color="normal"
+            )
+            if indice and c_ini < indice["inicio"]:
+                st.caption(f"⚠️ Dados carregados a partir de {indice['inicio'].strftime('%d/%m/%Y')}. "
+                           "Aumente 'Buscar últimos (dias)' para cobrir o período de comparação.")
+        else:
+            st.caption("Selecione a data inicial e final.")
+
     # --- KPI EXTRA: NÃO TRANSMITIDOS ---
     st.divider()
     
-    # Usamos o df_pendentes calculado ANTES do filtro strict
-    qtd_pendente = len(df_pendentes)
-    val_pendente = df_pendentes["Valor_Total_Frete"].sum()
-    
-    if qtd_pendente > 0:
-        st.warning(f"⚠️ **Atenção:** Existem **{qtd_pendente} CT-es** detectados como **Não Transmitidos** (R$ {val_pendente:,.2f}).")
-        with st.expander("Ver CT-es Não Transmitidos"):
-            st.dataframe(
-                df_pendentes[["Numero_CTe", "Data_Emissao", "Status_API", "Valor_Total_Frete"]]
-                .style.format({"Valor_Total_Frete": "R$ {:,.2f}", "Data_Emissao": "{:%d/%m %H:%M}"}),
-                use_container_width=True
-            )
+    painel_pendentes(mgr)
     
     st.divider()
 
@@ -581,23 +566,10 @@ if not df.empty:
     
     st.subheader(f"📊 Comparativo Dia a Dia ({nome_mes_atual} vs {nome_mes_passado})")
 
-    # Preparar Dados (Calendário Civil)
-    df_atual = df[df["Data_Ref"] >= start_atual].copy()
-    
-    df_anterior = df[
-        (df["Data_Ref"] >= start_anterior) & 
-        (df["Data_Ref"] <= end_anterior)
-    ].copy()
-
-    df_atual["Dia_Mes"] = df_atual["Data_Emissao"].dt.day
-    df_anterior["Dia_Mes"] = df_anterior["Data_Emissao"].dt.day
-
-    # Agrupar
-    grp_atual = df_atual.groupby("Dia_Mes")["Valor_Total_Frete"].sum().reset_index()
-    grp_atual["Periodo"] = "Atual"
-    
-    grp_anterior = df_anterior.groupby("Dia_Mes")["Valor_Total_Frete"].sum().reset_index()
-    grp_anterior["Periodo"] = "Anterior"
+    # Preparar Dados (Calendário Civil) e Agrupar
+    grp_atual, grp_anterior, ranking_filial = agrupar_comparativo(
+        df, start_atual, start_anterior, end_anterior, sem_copias=SEM_COPIAS
+    )
 
     # Criação do Gráfico de Barras
     fig = go.Figure()
@@ -635,6 +607,72 @@ if not df.empty:
 
     st.plotly_chart(fig, use_container_width=True)
 
+    # ------------------------------------------
+    # TENDÊNCIA DE LONGO PRAZO (MULTI-RESOLUÇÃO)
+    # ------------------------------------------
+    st.subheader("📈 Tendência de Faturamento")
+
+    # Agregados diário/semanal/mensal pré-calculados por versão dos dados;
+    # a resolução sai do período visível, então o gráfico nunca passa de
+    # TENDENCIA_MAX_PONTOS pontos por série, seja qual for o histórico.
+    tendencia = agregados_tendencia(df, mgr.chave_cache())
+    if tendencia and tendencia["fim"] > tendencia["inicio"]:
+        t_1, t_2 = st.columns([3, 2])
+        with t_1:
+            faixa = st.slider(
+                "Período visível",
+                min_value=tendencia["inicio"],
+                max_value=tendencia["fim"],
+                value=(tendencia["inicio"], tendencia["fim"]),
+                format="DD/MM/YY"
+            )
+        with t_2:
+            series_sel = st.multiselect(
+                "Séries", ["Todas"] + tendencia["filiais"], default=["Todas"], max_selections=6
+            )
+
+        res_tend, series_tend = serie_tendencia(tendencia, faixa[0], faixa[1], series_sel or ["Todas"])
+        cores = px.colors.qualitative.Prism
+
+        fig_t = go.Figure()
+        for i, (nome, s) in enumerate(series_tend.items()):
+            cor = cores[i % len(cores)]
+            if res_tend != "D":
+                # Envelope: menor e maior dia com emissão dentro de cada semana/mês
+                fig_t.add_trace(go.Scatter(
+                    x=s["Periodo"], y=s["Max"], mode="lines", line=dict(width=0),
+                    showlegend=False, hoverinfo="skip"
+                ))
+                fig_t.add_trace(go.Scatter(
+                    x=s["Periodo"], y=s["Min"], mode="lines", line=dict(width=0),
+                    fill="tonexty", fillcolor=cor.replace("rgb", "rgba").replace(")", ", 0.18)"),
+                    showlegend=False, hoverinfo="skip"
+                ))
+            fig_t.add_trace(go.Scatter(
+                x=s["Periodo"], y=s["Media"], mode="lines+markers", name=nome,
+                line=dict(color=cor, width=2), marker=dict(size=4),
+                customdata=s[["Soma", "Min", "Max"]].to_numpy(),
+                hovertemplate=(
+                    f"<b>{nome}</b> %{{x|%d/%m/%y}}<br>Média por dia c/ emissão: R$ %{{y:,.2f}}<br>"
+                    "Total: R$ %{customdata[0]:,.2f}<br>Min/Máx dia: R$ %{customdata[1]:,.2f} / R$ %{customdata[2]:,.2f}"
+                    "<extra></extra>"
+                )
+            ))
+
+        fig_t.update_layout(
+            xaxis_title=None,
+            yaxis_title="Faturamento por dia (R$)",
+            legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1),
+            margin=dict(l=20, r=20, t=30, b=20),
+            hovermode="x unified" if len(series_tend) > 1 else "closest"
+        )
+        st.plotly_chart(fig_t, use_container_width=True)
+
+        n_pontos = max((len(s) for s in series_tend.values()), default=0)
+        st.caption(f"Resolução {RESOLUCOES[res_tend]} · {n_pontos} pontos por série (máx. {TENDENCIA_MAX_PONTOS}). "
+                   "Linha = média por dia com emissão; faixa sombreada = menor e maior dia com emissão "
+                   "do período (dias sem CT-e, como fins de semana e feriados, ficam de fora).")
+
 
 
     # ------------------------------------------
@@ -650,18 +688,10 @@ if not df.empty:
         # Debug Temporário
         # st.write("Colunas disponíveis:", df.columns.tolist())
         
-        if "Filial" not in df.columns:
-            st.error("Erro: Coluna 'Filial' não encontrada no DataFrame.")
-            # Fallback para criar a coluna se não existir
-            df["Filial"] = "Não Identificada"
-            df_atual["Filial"] = "Não Identificada"
-
         c_filial, c_pie = st.columns(2)
         
         with c_filial:
             st.subheader("🏆 Filiais (Faturamento Mês)")
-            ranking_filial = df_atual.groupby("Filial")["Valor_Total_Frete"].sum().reset_index().sort_values("Valor_Total_Frete", ascending=True)
-            
             fig_f = px.bar(
                 ranking_filial,
                 x="Valor_Total_Frete",
@@ -709,57 +739,17 @@ if not df.empty:
     # ------------------------------------------
     st.subheader("🔮 Estimativa de Faturamento (Mês Atual)")
     
-    # Imports
-    import calendar
-    import numpy as np
-    
-    # 1. Preparar dados históricos
-    start_hist = hoje - timedelta(days=60) # Pega pelo menos 2 meses para ver tendencia recente
-    df_hist = df[
-        (df["Data_Ref"] >= start_hist) & 
-        (df["Data_Ref"] <= hoje)
-    ].copy()
+    # Engine vetorizada (Filial x Dia), cacheada por versão dos dados
+    previsao = projetar_faturamento(df, mgr.chave_cache(), hoje)
+    tabela_prev = previsao["filiais"]
+    previsao_total_mes = previsao["total"]
 
     # Debug de condições
-    has_data = len(df_hist) > 10
+    has_data = previsao["n_hist"] > 10
     
     # Permitir projeção mesmo que mês atual seja zero (início de mês), 
     # desde que haja histórico suficiente para traçar a tendência.
     if has_data:
-        # Agrupar por dia
-        df_hist["Data_Ref"] = pd.to_datetime(df_hist["Data_Ref"])
-        daily = df_hist.groupby("Data_Ref")["Valor_Total_Frete"].sum().reset_index()
-        daily = daily.sort_values("Data_Ref")
-        
-        # Lógica Ajustada: Média baseada no histórico do Mês Passado
-        # (Substitui regressão linear por projeção baseada na média diária do mês anterior)
-        
-        # Dias no mês passado
-        total_dias_passado = (mes_passado_end - mes_passado_start).days + 1
-        
-        if val_mes_passado > 0 and total_dias_passado > 0:
-            media_diaria_passada = val_mes_passado / total_dias_passado
-            
-            # Dias restantes no mês atual
-            last_day_month = calendar.monthrange(hoje.year, hoje.month)[1]
-            fim_do_mes = hoje.replace(day=last_day_month)
-            dias_restantes = (fim_do_mes - hoje).days
-            
-            if dias_restantes > 0:
-                previsao_restante = media_diaria_passada * dias_restantes
-                previsao_total_mes = val_mes_atual + previsao_restante
-            else:
-                previsao_total_mes = val_mes_atual
-        else:
-            # Fallback se não tiver histórico suficiente: usa média atual
-            if hoje.day > 0:
-                media_atual = val_mes_atual / hoje.day
-                last_day_month = calendar.monthrange(hoje.year, hoje.month)[1]
-                previsao_total_mes = media_atual * last_day_month
-            else:
-                previsao_total_mes = val_mes_atual
-                
-        
         # Comparativo com mês passado
         delta_forecast = 0
         if val_mes_passado > 0:
@@ -785,9 +775,23 @@ if not df.empty:
                 delta_color="normal"
             )
 
+        with st.expander("Projeção por Filial"):
+            st.dataframe(
+                tabela_prev.style.format({
+                    "Realizado": "R$ {:,.2f}",
+                    "Projecao_Restante": "R$ {:,.2f}",
+                    "Previsao_Mes": "R$ {:,.2f}",
+                }),
+                use_container_width=True,
+                hide_index=True
+            )
+            st.caption(f"Perfil por dia da semana das últimas {FORECAST_SEMANAS} semanas. "
+                       f"Restam {previsao['dias_uteis_restantes']} dias úteis (seg a sex, sem feriados nacionais fixos; "
+                       f"Carnaval, Sexta-feira Santa e Corpus Christi não são descontados).")
+
             
     else:
-        st.warning(f"Projeção indisponível no momento. (Dados Recentes: {len(df_hist)}, Faturamento Mês: {val_mes_atual:.2f})")
+        st.warning(f"Projeção indisponível no momento. (Dados Recentes: {previsao['n_hist']}, Faturamento Mês: {val_mes_atual:.2f})")
         st.caption("A IA precisa de pelo menos 5 dias de histórico recente e movimentação no mês atual para projetar.")
 
     st.divider()
@@ -796,15 +800,63 @@ if not df.empty:
     # TABELA FINAL (FULL WIDTH)
     # ------------------------------------------
     st.subheader("📝 Últimas Emissões (Recentes)")
+    # Top-k mantido pelo StatsManager (sem ordenar o DataFrame inteiro)
     st.dataframe(
-        df.sort_values("Data_Emissao", ascending=False)
-        .head(100)
-        [["Numero_CTe", "Data_Emissao", "Pagador", "Valor_Total_Frete", "Filial"]]
+        pd.DataFrame(
+            mgr.get_recentes(),
+            columns=["Numero_CTe", "Data_Emissao", "Pagador", "Valor_Total_Frete", "Filial"]
+        )
         .style.format({"Valor_Total_Frete": "R$ {:,.2f}", "Data_Emissao": "{:%d/%m %H:%M}"}),
         use_container_width=True,
         height=400
     )
 
+    # ------------------------------------------
+    # BUSCA DE CT-es (TODOS OS CARREGADOS)
+    # ------------------------------------------
+    st.subheader("🔎 Buscar CT-e")
+    busca = indice_busca(mgr.get_registros(), mgr.chave_cache())
+
+    b_1, b_2, b_3, b_4 = st.columns([1, 2, 1, 2])
+    with b_1:
+        busca_numero = st.text_input("Número CT-e")
+    with b_2:
+        busca_pagador = st.text_input("Pagador")
+        busca_contem = st.checkbox("Contém (em vez de começa com)")
+    with b_3:
+        busca_filial = st.selectbox("Filial", ["Todas"] + sorted(busca["filial"]), key="busca_filial")
+    with b_4:
+        busca_periodo = st.date_input("Emissão", value=(), format="DD/MM/YYYY")
+
+    busca_ini = busca_fim = None
+    if isinstance(busca_periodo, (list, tuple)) and len(busca_periodo) == 2:
+        busca_ini, busca_fim = busca_periodo
+
+    posicoes = buscar_ctes(
+        busca,
+        numero=busca_numero,
+        pagador=busca_pagador,
+        contem=busca_contem,
+        filial=None if busca_filial == "Todas" else busca_filial,
+        ini=busca_ini,
+        fim=busca_fim
+    )
+
+    # Paginação no servidor: só a página atual é formatada e enviada ao navegador
+    total_busca = len(posicoes)
+    n_paginas = max(1, -(-total_busca // BUSCA_PAGINA))
+    pagina = st.number_input("Página", min_value=1, max_value=n_paginas, value=1, step=1)
+    ini_pag = (pagina - 1) * BUSCA_PAGINA
+    pagina_df = busca["base"].iloc[posicoes[ini_pag:ini_pag + BUSCA_PAGINA]]
+
+    st.caption(f"Mostrando {min(ini_pag + 1, total_busca)}–{min(ini_pag + BUSCA_PAGINA, total_busca)} de {total_busca} CT-es (página {pagina}/{n_paginas}).")
+    st.dataframe(
+        pagina_df
+        .style.format({"Valor_Total_Frete": "R$ {:,.2f}", "Data_Emissao": "{:%d/%m/%Y %H:%M}"}, na_rep="—"),
+        use_container_width=True,
+        hide_index=True
+    )
+
 
 # ------------------------------------------
 # MENSAGEM DE ESPERA (CASO DF VAZIO)
@@ -857,3 +909,9 @@ if CONNECT_API and TOKEN:
     except Exception as e:
         status_placeholder.error(f"Erro sync: {e}")
         time.sleep(5) # Backoff em caso de erro grave
+
+    finally:
+        # Inclui o sync_step na captura, mesmo quando o passo termina em st.rerun()
+        finalizar_perfil(len(mgr.cte_storage), len(df))
+
+finalizar_perfil(0, len(df))
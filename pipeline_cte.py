@@ -0,0 +1,909 @@
+# ==========================================
+# PIPELINE DE DADOS - CT-e (ESI)
+# ==========================================
+# Leitura de XML, sincronização, índices e cálculos do painel.
+# Sem dependência do Streamlit: o dashboard importa daqui (e aplica o cache),
+# e o benchmark de memória (benchmarks/) roda o mesmo código isolado.
+
+import pandas as pd
+import numpy as np
+from datetime import datetime, timedelta, timezone
+import requests
+import xml.etree.ElementTree as ET
+import re
+import time
+import calendar
+import uuid
+import bisect
+import heapq
+import threading
+from collections import deque
+
+
+TOP_RECENTES = 100  # Tamanho da lista "Últimas Emissões"
+TENDENCIA_MAX_PONTOS = 120  # Limite de pontos por série no gráfico de tendência
+FORECAST_SEMANAS = 8  # Histórico usado no perfil semanal da projeção
+PENDENTES_POLL_SECONDS = 120  # 2 minutos (re-consulta só dos Não Transmitidos)
+
+
+# ------------------------------------------
+# FUNÇÃO: LER XML DO CT-e
+# ------------------------------------------
+def parse_cte_xml(xml_string, erros=None):
+    """Se `erros` (lista) for informado, recebe o motivo da falha quando retorna None."""
+    try:
+        if not xml_string:
+            raise ValueError("XML vazio")
+
+        # Limpeza
+        xml_string = re.sub(r'xmlns[^=]*="[^"]*"', '', xml_string)
+        xml_string = re.sub(r'(<\/?)\w+:', r'\1', xml_string)
+
+        root = ET.fromstring(xml_string)
+        inf = root.find(".//infCte")
+        if inf is None:
+            raise ValueError("Tag infCte ausente")
+
+        ide = inf.find("ide")
+        numero = ide.findtext("nCT", default="S/N")
+        dh_emi = ide.findtext("dhEmi")
+
+        # Data com Fuso
+        data = pd.to_datetime(dh_emi, errors="coerce")
+        if data is not None:
+            # Garante remoção de TZ para comparar com datas locais
+            data = data.replace(tzinfo=None)
+
+        valor = float(inf.findtext(".//vTPrest", default="0"))
+        pagador = inf.findtext(".//rem/xNome", default="Cliente Diverso")
+        
+        # Extração de Filial (Emitente)
+        xFant = inf.findtext(".//emit/xFant")
+        xNome = inf.findtext(".//emit/xNome")
+        filial = xFant if xFant else (xNome if xNome else "Matriz")
+
+        # Data de Transmissão (Protocolo)
+        prot = root.find(".//protCTe")
+        data_transmissao = None
+        if prot:
+            infProt = prot.find("infProt")
+            if infProt is not None:
+                dh_recbto = infProt.findtext("dhRecbto")
+                if dh_recbto:
+                    dt_trans = pd.to_datetime(dh_recbto, errors="coerce")
+                    if dt_trans is not None:
+                        data_transmissao = dt_trans.replace(tzinfo=None)
+
+        return {
+            "Numero_CTe": numero,
+            "Data_Emissao": data,
+            "Data_Transmissao": data_transmissao,
+            "Pagador": pagador,
+            "Filial": filial,
+            "Valor_Total_Frete": valor
+        }
+    except Exception as e:
+        if erros is not None:
+            erros.append(f"{type(e).__name__}: {e}"[:200])
+        return None
+
+
+# ------------------------------------------
+# FUNÇÃO: BUSCAR DADOS (INCREMENTAL)
+# ------------------------------------------
+# Removido cache_data para gerenciar manualmente no session_state
+# FUNÇÃO: BUSCAR DADOS (PAGINADO COM CURSOR)
+# ------------------------------------------
+def fetch_batch(token, subdomain, start_param):
+    """
+    Busca UM ou ALGUNS lotes de dados.
+    start_param: pode ser {"since": "..."} ou {"start": "NEXT_ID"}
+    Retorna: (lista_items, proximo_cursor_str ou None)
+    """
+    base_url = f"https://{subdomain}.eslcloud.com.br/api/ctes"
+    headers = {"Authorization": f"Token {token}"}
+    
+    # Adiciona limite padrão
+    params = start_param.copy()
+    params["limit"] = 100 
+    
+    try:
+        r = requests.get(base_url, headers=headers, params=params, timeout=15)
+        if r.status_code != 200:
+            return [], None
+        payload = r.json()
+    except:
+        return [], None
+        
+    items = payload.get("data", [])
+    next_id = payload.get("paging", {}).get("next_id")
+    
+    return items, next_id
+
+def fetch_cte(token, subdomain, cte_id):
+    """
+    Busca UM CT-e específico pelo id da API (usado para re-checar pendentes).
+    Retorna o item no mesmo formato da listagem ou None.
+    """
+    url = f"https://{subdomain}.eslcloud.com.br/api/ctes/{cte_id}"
+    headers = {"Authorization": f"Token {token}"}
+    
+    try:
+        r = requests.get(url, headers=headers, timeout=15)
+        if r.status_code != 200:
+            return None
+        payload = r.json()
+    except:
+        return None
+    
+    item = payload.get("data", payload) if isinstance(payload, dict) else None
+    if isinstance(item, list):
+        item = item[0] if item else None
+    return item or None
+
+# ------------------------------------------
+# AUXILIAR: Data_Ref pode ser `date` (objeto) ou datetime64 (modo sem cópias)
+# ------------------------------------------
+def _limite(data_ref, d):
+    """Converte a data de corte para o mesmo tipo da coluna Data_Ref."""
+    return pd.Timestamp(d) if pd.api.types.is_datetime64_any_dtype(data_ref) else d
+
+
+# ------------------------------------------
+# FUNÇÃO: PREVISÃO DE FATURAMENTO (VETORIZADA)
+# ------------------------------------------
+# Feriados nacionais fixos (mês, dia) - não contam como dia útil.
+# Os móveis (Carnaval, Sexta-feira Santa, Corpus Christi) NÃO estão na lista.
+FERIADOS_FIXOS = {(1, 1), (4, 21), (5, 1), (9, 7), (10, 12), (11, 2), (11, 15), (11, 20), (12, 25)}
+
+def _mascara_dias_uteis(dias):
+    """True nos dias úteis: segunda a sexta, fora dos feriados fixos."""
+    if len(dias) == 0:
+        return np.zeros(0, dtype=bool)
+    feriados = [np.datetime64(f"{ano}-{mes:02d}-{dia:02d}")
+                for ano in range(dias[0].year, dias[-1].year + 1)
+                for mes, dia in FERIADOS_FIXOS]
+    return np.is_busday(dias.values.astype("datetime64[D]"), holidays=feriados)
+
+def _one_hot_semana(dias):
+    """Matriz (dias x 7) com 1 no dia da semana de cada data útil."""
+    oh = np.zeros((len(dias), 7))
+    oh[np.arange(len(dias)), dias.weekday] = 1.0
+    oh[~_mascara_dias_uteis(dias)] = 0.0
+    return oh
+
+def projetar_faturamento(_df, versao, hoje, semanas=FORECAST_SEMANAS):
+    """
+    Projeta o fechamento do mês para TODAS as filiais numa única passada NumPy.
+    Monta a matriz (filial x dia) do histórico, tira o perfil médio por dia da
+    semana (só dias úteis) e soma esse perfil nos dias úteis que faltam no mês.
+    `versao` é a chave do cache (StatsManager.chave_cache()); `_df` não é hasheado.
+    """
+    inicio_hist = hoje - timedelta(weeks=semanas)
+    inicio_mes = hoje.replace(day=1)
+    inicio = min(inicio_hist, inicio_mes)
+
+    data_ref = _df["Data_Ref"]
+    mask = (data_ref >= _limite(data_ref, inicio)) & (data_ref <= _limite(data_ref, hoje))
+    janela = _df.loc[mask, ["Data_Ref", "Filial", "Valor_Total_Frete"]]
+    codigos, filiais = pd.factorize(janela["Filial"], sort=True)
+    dia_idx = (pd.to_datetime(janela["Data_Ref"]) - pd.Timestamp(inicio)).dt.days.to_numpy()
+    valores = janela["Valor_Total_Frete"].to_numpy(dtype=float)
+
+    n_dias = (hoje - inicio).days + 1
+    matriz = np.zeros((len(filiais), n_dias))
+    np.add.at(matriz, (codigos, dia_idx), valores)
+
+    # Perfil semanal: histórico até ontem (hoje ainda está em andamento)
+    off_hist = (inicio_hist - inicio).days
+    dias_hist = pd.date_range(inicio_hist, hoje - timedelta(days=1))
+    oh_hist = _one_hot_semana(dias_hist)
+    ocorrencias = oh_hist.sum(axis=0)
+    perfil = (matriz[:, off_hist:n_dias - 1] @ oh_hist) / np.maximum(ocorrencias, 1)
+
+    # Dias úteis restantes (amanhã até o fim do mês)
+    fim_mes = hoje.replace(day=calendar.monthrange(hoje.year, hoje.month)[1])
+    dias_fut = pd.date_range(hoje + timedelta(days=1), fim_mes)
+    oh_fut = _one_hot_semana(dias_fut)
+
+    realizado = matriz[:, (inicio_mes - inicio).days:].sum(axis=1)
+    restante = perfil @ oh_fut.sum(axis=0)
+
+    tabela = pd.DataFrame({
+        "Filial": filiais,
+        "Realizado": realizado,
+        "Projecao_Restante": restante,
+        "Previsao_Mes": realizado + restante,
+    }).sort_values("Previsao_Mes", ascending=False)
+
+    n_hist = int(((dia_idx >= off_hist) & (dia_idx < n_dias - 1)).sum()) if len(dia_idx) else 0
+    return {
+        "filiais": tabela,
+        "total": float(tabela["Previsao_Mes"].sum()),
+        "n_hist": n_hist,
+        "dias_uteis_restantes": int(oh_fut.sum()),
+    }
+
+
+# ------------------------------------------
+# FUNÇÃO: ÍNDICE DE PERÍODOS (SOMAS ACUMULADAS)
+# ------------------------------------------
+def indice_periodos(_df, versao):
+    """
+    Somas acumuladas diárias de valor e quantidade, por Filial e geral (última linha).
+    A soma de qualquer intervalo vira duas leituras: cum[fim + 1] - cum[ini].
+    """
+    base = _df[["Data_Ref", "Filial", "Valor_Total_Frete"]].dropna(subset=["Data_Ref"])
+    if base.empty:
+        return None
+
+    dias = pd.to_datetime(base["Data_Ref"])
+    inicio = dias.min()
+    dia_idx = (dias - inicio).dt.days.to_numpy()
+    n_dias = int(dia_idx.max()) + 1
+    codigos, filiais = pd.factorize(base["Filial"], sort=True)
+
+    # Coluna 0 fica zerada para o cum[ini] do primeiro dia
+    valor = np.zeros((len(filiais) + 1, n_dias + 1))
+    qtd = np.zeros((len(filiais) + 1, n_dias + 1), dtype=np.int64)
+    np.add.at(valor, (codigos, dia_idx + 1), base["Valor_Total_Frete"].to_numpy(dtype=float))
+    np.add.at(qtd, (codigos, dia_idx + 1), 1)
+    valor[-1] = valor[:-1].sum(axis=0)
+    qtd[-1] = qtd[:-1].sum(axis=0)
+
+    return {
+        "inicio": inicio.date(),
+        "filiais": list(filiais),
+        "linhas": {f: i for i, f in enumerate(filiais)},
+        "valor": np.cumsum(valor, axis=1),
+        "qtd": np.cumsum(qtd, axis=1),
+    }
+
+def soma_periodo(indice, ini, fim, filial=None):
+    """(valor, qtd) de ini até fim (inclusive) em O(1). filial=None soma todas."""
+    if indice is None:
+        return 0.0, 0
+    linha = -1 if filial is None else indice["linhas"].get(filial)
+    if linha is None:
+        return 0.0, 0
+
+    n_dias = indice["valor"].shape[1] - 1
+    a = min(max((ini - indice["inicio"]).days, 0), n_dias)
+    b = min(max((fim - indice["inicio"]).days + 1, 0), n_dias)
+    if b <= a:
+        return 0.0, 0
+    return (float(indice["valor"][linha, b] - indice["valor"][linha, a]),
+            int(indice["qtd"][linha, b] - indice["qtd"][linha, a]))
+
+
+# ------------------------------------------
+# FUNÇÃO: ÍNDICE DE BUSCA DE CT-es
+# ------------------------------------------
+def indice_busca(_registros, versao):
+    """
+    Índices sobre todos os CT-es carregados (qualquer status), ordenados do mais
+    recente para o mais antigo. Cada índice aponta para posições dessa ordem,
+    então interseções já saem ordenadas e a paginação é um simples fatiamento.
+    """
+    base = pd.DataFrame(
+        _registros,
+        columns=["Numero_CTe", "Data_Emissao", "Pagador", "Filial", "Valor_Total_Frete", "Status_API"]
+    )
+    base = base.sort_values("Data_Emissao", ascending=False, na_position="last", kind="stable").reset_index(drop=True)
+
+    # Datas negadas -> vetor crescente para searchsorted (NaT vai para o fim)
+    ts = base["Data_Emissao"].to_numpy(dtype="datetime64[ns]").astype(np.int64)
+    datas = np.where(base["Data_Emissao"].isna().to_numpy(), np.iinfo(np.int64).max, -ts)
+
+    def posicoes(coluna):
+        return {k: np.asarray(v, dtype=np.int64) for k, v in base.groupby(coluna, sort=False).indices.items()}
+
+    por_pagador = posicoes(base["Pagador"].str.lower())
+    return {
+        "base": base,
+        "datas": datas,
+        "numero": posicoes("Numero_CTe"),
+        "filial": posicoes("Filial"),
+        "pagador": por_pagador,
+        "pagadores": sorted(por_pagador),
+    }
+
+def buscar_ctes(indice, numero=None, pagador=None, contem=False, filial=None, ini=None, fim=None):
+    """Retorna as posições (já em ordem de data desc.) que atendem a todos os filtros."""
+    n = len(indice["base"])
+    a, b = 0, n
+    if fim is not None:
+        a = int(np.searchsorted(indice["datas"], -pd.Timestamp(fim + timedelta(days=1)).value, side="right"))
+    if ini is not None:
+        b = int(np.searchsorted(indice["datas"], -pd.Timestamp(ini).value, side="right"))
+
+    filtros = []
+    if numero:
+        filtros.append(indice["numero"].get(numero.strip(), np.empty(0, dtype=np.int64)))
+    if filial:
+        filtros.append(indice["filial"].get(filial, np.empty(0, dtype=np.int64)))
+    if pagador:
+        termo = pagador.strip().lower()
+        if contem:
+            nomes = [p for p in indice["pagadores"] if termo in p]
+        else:
+            # Prefixo: faixa contígua na lista ordenada
+            i = bisect.bisect_left(indice["pagadores"], termo)
+            j = bisect.bisect_left(indice["pagadores"], termo + "\uffff")
+            nomes = indice["pagadores"][i:j]
+        filtros.append(np.sort(np.concatenate([indice["pagador"][p] for p in nomes])) if nomes else np.empty(0, dtype=np.int64))
+
+    if not filtros:
+        return np.arange(a, b)
+    pos = filtros[0]
+    for f in filtros[1:]:
+        pos = np.intersect1d(pos, f, assume_unique=True)
+    return pos[(pos >= a) & (pos < b)]
+
+
+# ------------------------------------------
+# REGRAS DE STATUS
+# ------------------------------------------
+STATUS_EXCLUIDOS = ("canceled", "denied")
+
+def eh_autorizado(reg):
+    return str(reg.get("Status_API")).lower().strip() == "authorized"
+
+def eh_pendente(reg):
+    """CT-e ainda não transmitido: sem autorização ou sem protocolo (dhRecbto), ignorando cancelados/denegados."""
+    status = reg.get("Status_API")
+    if status in STATUS_EXCLUIDOS:
+        return False
+    return status != "authorized" or pd.isna(reg.get("Data_Transmissao"))
+
+
+# ------------------------------------------
+# GERENCIADOR DE DADOS GLOBAL (Persiste no F5)
+# ------------------------------------------
+class StatsManager:
+    def __init__(self):
+        self.cte_storage = {}
+        self.last_days_back = 0
+        self.last_sync_time = None
+        
+        # Estado de sincronização contínua
+        self.resume_token = None # Se diferente de None, indica que tem mais páginas
+        self.is_syncing = False # Flag visual
+        self.current_params = {} # Armazena os parâmetros da última requisição para continuar
+        self.geracao = uuid.uuid4().hex  # Distingue este gerenciador de um recriado no reset
+
+        # Um único gerenciador atende todas as sessões (cache_resource): quem escreve
+        # (sync / poll) e quem lê (renders) passa por este lock
+        self._lock = threading.RLock()
+
+        # Índices mantidos incrementalmente (CDC)
+        self._reiniciar_indices()
+
+    def get_all(self):
+        with self._lock:
+            return list(self.cte_storage.values())
+
+    def chave_cache(self):
+        """Chave dos índices em cache: muda a cada delta e quando o gerenciador é recriado."""
+        return (self.geracao, self.versao)
+
+    def get_registros(self):
+        """Registros já parseados (um por CT-e), sem re-ler XML."""
+        with self._lock:
+            return list(self.registros.values())
+
+    def get_resumo_status(self):
+        """Cópia de status -> (qtd, valor)."""
+        with self._lock:
+            return {status: tuple(acc) for status, acc in self.resumo_status.items()}
+
+    def get_resumo_pendentes(self):
+        """(quantidade, valor) dos Não Transmitidos, lidos juntos."""
+        with self._lock:
+            return len(self.pendentes), self.valor_pendente
+
+    def get_quarentena(self):
+        """Cópia das falhas de parse (as entradas são alteradas na ingestão)."""
+        with self._lock:
+            return [dict(falha) for falha in self.quarentena.values()]
+
+    def get_transicoes(self, limite=20):
+        with self._lock:
+            return list(self.transicoes)[:limite]
+
+    def _reiniciar_indices(self):
+        """Recria os índices derivados a partir do cte_storage (sem emitir eventos)."""
+        with self._lock:
+            self._reconstruir_indices()
+
+    def _reconstruir_indices(self):
+        self.registros = {}      # item_id -> dict parseado (com Status_API)
+        self.assinaturas = {}    # item_id -> (status, hash do xml) para detectar mudanças
+        self.resumo_status = {}  # status -> [qtd, valor]
+        self.pendentes = set()   # item_ids não transmitidos
+        self.valor_pendente = 0.0  # soma corrente do valor dos pendentes
+        self.last_poll_pendentes = time.time()
+        self.ultimo_poll = {}    # item_id -> quando o pendente foi re-consultado pela última vez
+        self.recentes = []       # top-k autorizados, ordenado por (Data_Emissao, chave)
+        self.recentes_incompleto = False
+        self.quarentena = {}     # item_id -> falha de parse (não re-lemos até o XML mudar)
+        self.chave_por_digest = {}  # hash do xml -> item_id, para payloads sem id na API
+        self.transicoes = deque(maxlen=50)  # feed de mudanças recentes
+        self.versao = 0          # incrementa a cada delta aplicado
+        for item_id, item in list(self.cte_storage.items()):
+            self._ingerir(item_id, item, emitir=False)
+
+    def _aplicar_resumo(self, reg, sinal):
+        if reg is None:
+            return
+        acc = self.resumo_status.setdefault(reg["Status_API"], [0, 0.0])
+        acc[0] += sinal
+        acc[1] += sinal * reg["Valor_Total_Frete"]
+        if acc[0] <= 0:
+            del self.resumo_status[reg["Status_API"]]
+
+    def _ingerir(self, item_id, item, emitir=True, parsed=None, erros=None):
+        """
+        Registra um item da API e aplica a diferença (novo / status / valor / transmissão)
+        nos agregados, sem reprocessar o restante da base. Chamar com self._lock.
+        `parsed` / `erros` reaproveitam o parse_cte_xml já feito pelo chamador
+        (parsed=None com `erros` preenchido = falhou, não re-lemos).
+        Retorna True se o CT-e ainda não existia.
+        """
+        cte = item.get("cte", item)
+        xml = cte.get("xml") or cte.get("content")
+        status = cte.get("status", "unknown")
+        is_new = item_id not in self.cte_storage
+        self.cte_storage[item_id] = item
+
+        digest = hash(xml)
+        if not (cte.get("id") or item.get("id")):
+            self.chave_por_digest[digest] = item_id
+        assinatura = (status, digest)
+        if self.assinaturas.get(item_id) == assinatura:
+            if item_id in self.quarentena:
+                self.quarentena[item_id]["Ocorrencias"] += 1
+            return is_new  # Nada mudou desde a última vez
+        self.assinaturas[item_id] = assinatura
+
+        antigo = self.registros.get(item_id)
+        falha = self.quarentena.get(item_id)
+        if falha and falha["Digest"] == digest:
+            # Mesmo XML que já falhou: só o status mudou, não adianta re-ler
+            falha["Status"] = status
+            falha["Ocorrencias"] += 1
+            novo = None
+        else:
+            if parsed is None and not erros:
+                erros = []
+                novo = parse_cte_xml(xml, erros)
+            else:
+                novo = parsed
+            if novo:
+                novo["Status_API"] = status
+                self.quarentena.pop(item_id, None)
+            else:
+                self.quarentena[item_id] = {
+                    "Chave": str(item_id),
+                    "Status": status,
+                    "Motivo": erros[0] if erros else "Desconhecido",
+                    "Desde": datetime.now(),
+                    "Ocorrencias": 1,
+                    "Digest": digest,
+                }
+
+        # Desfaz a contribuição antiga e aplica a nova
+        self._aplicar_resumo(antigo, -1)
+        self._aplicar_resumo(novo, +1)
+        if item_id in self.pendentes:
+            self.pendentes.discard(item_id)
+            self.valor_pendente -= antigo["Valor_Total_Frete"]
+        if novo:
+            self.registros[item_id] = novo
+            if eh_pendente(novo):
+                self.pendentes.add(item_id)
+                self.valor_pendente += novo["Valor_Total_Frete"]
+        else:
+            self.registros.pop(item_id, None)
+        if not self.pendentes:
+            self.valor_pendente = 0.0  # Evita resíduo de ponto flutuante
+        self._atualizar_recentes(item_id, antigo, novo)
+        self.versao += 1
+
+        if emitir and antigo and novo:
+            mudancas = [
+                ("status", antigo["Status_API"], novo["Status_API"]),
+                ("valor", antigo["Valor_Total_Frete"], novo["Valor_Total_Frete"]),
+                ("transmissao", antigo["Data_Transmissao"], novo["Data_Transmissao"]),
+            ]
+            for tipo, de, para in mudancas:
+                if de != para and not (pd.isna(de) and pd.isna(para)):
+                    self.transicoes.appendleft({
+                        "Quando": datetime.now(),
+                        "Tipo": tipo,
+                        "Numero_CTe": novo["Numero_CTe"],
+                        "De": de,
+                        "Para": para,
+                    })
+        return is_new
+        
+    def sync_step(self, token, subdomain, days_back, time_limit=2.0):
+        """
+        Executa passos de sincronização por no máximo `time_limit` segundos.
+        Retorna (novos_items_count, continua_proxima_run?)
+        """
+        fuso_br = timezone(timedelta(hours=-3))
+        agora = datetime.now(fuso_br)
+        start_time = time.time()
+        
+        # 1. Detectar necessidade de Full Reload (Resetar cursor)
+        if days_back > self.last_days_back:
+            # User pediu mais dias, resetamos para buscar tudo desde o novo 'since'
+            self.last_days_back = days_back
+            self.resume_token = None
+            
+            since = (agora - timedelta(days=days_back)).strftime("%Y-%m-%dT%H:%M:%S.000-03:00")
+            self.current_params = {"since": since}
+            
+        elif not self.cte_storage and not self.resume_token:
+             # Cache vazio (primeiro load) e não estamos no meio de uma sync
+            self.last_days_back = days_back
+            self.resume_token = None
+            since = (agora - timedelta(days=days_back)).strftime("%Y-%m-%dT%H:%M:%S.000-03:00")
+            self.current_params = {"since": since}
+
+        elif self.resume_token is None:
+            # Incremental (só os últimos 7 dias)
+            # Iniciamos um novo ciclo incremental se não houver um em andamento
+            start_date = agora - timedelta(days=7)
+            since = start_date.strftime("%Y-%m-%dT%H:%M:%S.000-03:00")
+            self.current_params = {"since": since}
+        
+        # Se resume_token já tem next_id (continuação), usamos ele
+        if self.resume_token:
+            self.current_params = {"start": self.resume_token}
+            
+        count_new_session = 0
+        has_more = False
+        
+        # Loop pequeno (Time Boxed)
+        while True:
+            # Verifica tempo
+            if (time.time() - start_time) > time_limit:
+                 has_more = True
+                 break
+            
+            items, next_id = fetch_batch(token, subdomain, self.current_params)
+            
+            if not items:
+                # Fim da linha para este batch
+                if not next_id:
+                    self.resume_token = None # Fim total
+                    has_more = False
+                    break
+            
+            # Processar Itens (um lote por vez sob o lock: leitores veem o lote inteiro ou nada)
+            with self._lock:
+                for item in items:
+                    try:
+                        cte_data = item.get("cte", item)
+                        item_id = cte_data.get("id") or item.get("id")
+                        parsed = None
+                        erros = []
+                    
+                        if not item_id:
+                            xml_c = cte_data.get("xml") or cte_data.get("content")
+                            if xml_c:
+                                digest = hash(xml_c)
+                                # XML já visto: a chave sai do mapa, sem re-parse
+                                item_id = self.chave_por_digest.get(digest)
+                                if item_id is None:
+                                    parsed = parse_cte_xml(xml_c, erros)
+                                    # Hash fallback quando nem o XML dá a chave
+                                    item_id = (parsed or {}).get("Numero_CTe") or str(digest)
+                    
+                        if item_id:
+                            if self._ingerir(item_id, item, parsed=parsed, erros=erros):
+                                count_new_session += 1
+                    except:
+                        pass
+            
+            # Preparar próxima página
+            if next_id:
+                self.resume_token = next_id
+                self.current_params = {"start": next_id}
+                has_more = True # Tem mais, mas vamos ver se dá tempo de pegar no proximo loop
+            else:
+                self.resume_token = None
+                has_more = False
+                break
+        
+        self.last_sync_time = datetime.now()
+        self.is_syncing = has_more
+        return count_new_session, has_more
+
+    @staticmethod
+    def _chave_recente(item_id, reg):
+        if reg is None or not eh_autorizado(reg) or pd.isna(reg["Data_Emissao"]):
+            return None
+        return (reg["Data_Emissao"], str(item_id), item_id)
+
+    def _atualizar_recentes(self, item_id, antigo, novo):
+        """Mantém o top-k dos autorizados mais recentes sem ordenar a base inteira."""
+        chave_antiga = self._chave_recente(item_id, antigo)
+        removido = False
+        if chave_antiga is not None:
+            pos = bisect.bisect_left(self.recentes, chave_antiga)
+            if pos < len(self.recentes) and self.recentes[pos] == chave_antiga:
+                self.recentes.pop(pos)
+                removido = True
+
+        chave = self._chave_recente(item_id, novo)
+        if chave is not None and (len(self.recentes) < TOP_RECENTES or chave > self.recentes[0]):
+            bisect.insort(self.recentes, chave)
+            if len(self.recentes) > TOP_RECENTES:
+                self.recentes.pop(0)
+
+        # Saiu do top-k sem voltar na mesma posição (ou acima): o próximo candidato
+        # só é conhecido varrendo a base
+        if removido and (chave is None or chave < chave_antiga):
+            self.recentes_incompleto = True
+
+    def get_recentes(self):
+        """Últimas emissões autorizadas (mais recente primeiro)."""
+        with self._lock:
+            if self.recentes_incompleto:
+                chaves = (self._chave_recente(i, r) for i, r in self.registros.items())
+                self.recentes = sorted(heapq.nlargest(TOP_RECENTES, (c for c in chaves if c is not None)))
+                self.recentes_incompleto = False
+            return [self.registros[c[2]] for c in reversed(self.recentes)]
+
+    def get_pendentes(self):
+        """Registros Não Transmitidos (O(pendentes), sem varrer a base)."""
+        with self._lock:
+            return [self.registros[i] for i in self.pendentes]
+
+    def poll_pendentes(self, token, subdomain, intervalo=PENDENTES_POLL_SECONDS, time_limit=3.0):
+        """
+        Re-consulta individualmente os CT-es pendentes, numa cadência própria
+        (mais curta que a sincronização completa).
+        Retorna True se algum deles mudou.
+        """
+        with self._lock:
+            # Checa e marca juntos: só uma sessão faz a rodada
+            if not self.pendentes or (time.time() - self.last_poll_pendentes) < intervalo:
+                return False
+            self.last_poll_pendentes = time.time()
+            versao_antes = self.versao
+            # Quem espera há mais tempo vai primeiro: se o time_limit cortar a rodada,
+            # os que ficaram de fora encabeçam a próxima
+            self.ultimo_poll = {i: t for i, t in self.ultimo_poll.items() if i in self.pendentes}
+            fila = sorted(self.pendentes, key=lambda i: self.ultimo_poll.get(i, 0.0))
+        start_time = time.time()
+        
+        # As chamadas à API ficam fora do lock; só a ingestão segura os leitores
+        for item_id in fila:
+            if (time.time() - start_time) > time_limit:
+                break
+            self.ultimo_poll[item_id] = time.time()
+            item = self.cte_storage.get(item_id, {})
+            api_id = item.get("cte", item).get("id") or item.get("id")
+            if not api_id:
+                continue  # Chave por hash (sem id na API): fica para a sync normal
+            novo = fetch_cte(token, subdomain, api_id)
+            if not novo:
+                continue
+            cte = novo.get("cte", novo)
+            xml = cte.get("xml") or cte.get("content")
+            if not xml:
+                continue  # Resposta sem XML: mantém o registro atual
+            if self.assinaturas.get(item_id) == (cte.get("status", "unknown"), hash(xml)):
+                continue  # Nada mudou
+            parsed = parse_cte_xml(xml)
+            with self._lock:
+                atual = self.registros.get(item_id)
+                if not parsed or atual is None or parsed.get("Numero_CTe") != atual.get("Numero_CTe"):
+                    continue  # Não é o mesmo CT-e (ou não deu para ler): não substitui
+                self._ingerir(item_id, novo, parsed=parsed)
+        
+        return self.versao != versao_antes
+
+
+# ------------------------------------------
+# FUNÇÃO: MONTAR DATAFRAME DO PAINEL
+# ------------------------------------------
+COLUNAS_DF = ["Numero_CTe", "Data_Emissao", "Data_Transmissao", "Pagador", "Filial", "Valor_Total_Frete", "Status_API"]
+
+def montar_df(registros, sem_copias=False):
+    """
+    DataFrame do financeiro (só autorizados) com Data_Ref e Lag_Minutos.
+    sem_copias=True filtra ainda na lista de registros e cria as colunas derivadas
+    in-place num único DataFrame, com Data_Ref em datetime64 (8 bytes/linha, em vez
+    de um objeto `date` por linha); o modo padrão monta o DataFrame de todos os
+    status, normaliza e filtra (uma cópia a mais do frame inteiro).
+    """
+    if sem_copias:
+        df = pd.DataFrame.from_records([r for r in registros if eh_autorizado(r)], columns=COLUNAS_DF)
+        if df.empty:
+            return df
+        df["Data_Ref"] = df["Data_Emissao"].dt.normalize()
+    else:
+        records = [r for r in registros if r["Status_API"] not in STATUS_EXCLUIDOS]
+        df = pd.DataFrame(records)
+        if df.empty:
+            return df
+        df["Data_Ref"] = df["Data_Emissao"].dt.date
+
+        # --- FILTRO FINAL: APENAS AUTORIZADOS PARA O FINANCEIRO ---
+        # Convertemos para minúsculo para garantir compatibilidade
+        df["Status_Normalizado"] = df["Status_API"].astype(str).str.lower().str.strip()
+        df = df[df["Status_Normalizado"] == "authorized"]
+
+    if "Filial" not in df.columns:
+        df["Filial"] = "Não Identificada"
+
+    # Identificar Lag (Atraso na transmissão) em Minutos
+    df["Lag_Minutos"] = (df["Data_Transmissao"] - df["Data_Emissao"]).dt.total_seconds() / 60.0
+    df["Lag_Minutos"] = df["Lag_Minutos"].fillna(0)
+    return df
+
+def agrupar_comparativo(df, start_atual, start_anterior, end_anterior, sem_copias=False):
+    """
+    Faturamento por dia do mês (atual x anterior) e ranking de filiais do mês atual.
+    sem_copias=True agrupa só as colunas necessárias via máscara, sem copiar
+    os recortes do DataFrame.
+    """
+    data_ref = df["Data_Ref"]
+    mask_atual = data_ref >= _limite(data_ref, start_atual)
+    mask_anterior = (data_ref >= _limite(data_ref, start_anterior)) & (data_ref <= _limite(data_ref, end_anterior))
+
+    if sem_copias:
+        valor = df["Valor_Total_Frete"]
+        dia = df["Data_Emissao"].dt.day.rename("Dia_Mes")
+        grp_atual = valor[mask_atual].groupby(dia[mask_atual]).sum().reset_index()
+        grp_anterior = valor[mask_anterior].groupby(dia[mask_anterior]).sum().reset_index()
+        ranking_filial = valor[mask_atual].groupby(df["Filial"][mask_atual]).sum().reset_index()
+    else:
+        df_atual = df[mask_atual].copy()
+        df_anterior = df[mask_anterior].copy()
+
+        df_atual["Dia_Mes"] = df_atual["Data_Emissao"].dt.day
+        df_anterior["Dia_Mes"] = df_anterior["Data_Emissao"].dt.day
+
+        grp_atual = df_atual.groupby("Dia_Mes")["Valor_Total_Frete"].sum().reset_index()
+        grp_anterior = df_anterior.groupby("Dia_Mes")["Valor_Total_Frete"].sum().reset_index()
+        ranking_filial = df_atual.groupby("Filial")["Valor_Total_Frete"].sum().reset_index()
+
+    grp_atual["Periodo"] = "Atual"
+    grp_anterior["Periodo"] = "Anterior"
+    ranking_filial = ranking_filial.sort_values("Valor_Total_Frete", ascending=True)
+    return grp_atual, grp_anterior, ranking_filial
+
+
+# ------------------------------------------
+# FUNÇÃO: AGREGADOS DE TENDÊNCIA (MULTI-RESOLUÇÃO)
+# ------------------------------------------
+RESOLUCOES = {"D": "Diária", "W": "Semanal", "M": "Mensal"}
+
+def agregados_tendencia(_df, versao):
+    """
+    Pré-agrega o faturamento diário por Filial (e "Todas") em três resoluções:
+    diária, semanal (semanas começando na segunda) e mensal. Cada balde guarda
+    Soma, Min/Max do valor diário (envelope) e Dias, então o gráfico troca de
+    resolução sem voltar ao DataFrame. Min/Max e Dias consideram só os dias com
+    emissão: fins de semana e feriados sem CT-e não puxam o envelope para zero
+    nem diluem a média.
+    """
+    base = _df[["Data_Ref", "Filial", "Valor_Total_Frete"]].dropna(subset=["Data_Ref"])
+    if base.empty:
+        return None
+
+    dias = pd.to_datetime(base["Data_Ref"]).rename("Dia")
+    grupos = base["Valor_Total_Frete"].groupby([dias, base["Filial"]])
+    diario = grupos.sum().unstack(fill_value=0.0)
+    emitiu = grupos.size().unstack(fill_value=0) > 0
+    # Dias sem emissão entram como zero na série diária, mas ficam fora do envelope
+    calendario = pd.date_range(diario.index.min(), diario.index.max(), freq="D")
+    diario = diario.reindex(calendario, fill_value=0.0)
+    emitiu = emitiu.reindex(calendario, fill_value=False)
+    filiais = sorted(diario.columns)
+    diario["Todas"] = diario.sum(axis=1)
+    emitiu["Todas"] = emitiu.any(axis=1)
+    com_emissao = diario.where(emitiu)  # NaN nos dias sem CT-e (ignorado por min/max/count)
+
+    niveis = {"D": {"soma": diario, "min": diario, "max": diario, "dias": emitiu.astype(int)}}
+    for res, regra in (("W", "W-MON"), ("M", "MS")):
+        baldes = com_emissao.resample(regra, label="left", closed="left") if res == "W" else com_emissao.resample(regra)
+        niveis[res] = {
+            "soma": baldes.sum(),
+            "min": baldes.min().fillna(0.0),
+            "max": baldes.max().fillna(0.0),
+            "dias": baldes.count(),
+        }
+
+    return {
+        "inicio": diario.index.min().date(),
+        "fim": diario.index.max().date(),
+        "filiais": filiais,
+        "niveis": niveis,
+    }
+
+def escolher_resolucao(ini, fim, max_pontos=TENDENCIA_MAX_PONTOS):
+    """A resolução mais fina que cabe em `max_pontos` pontos no intervalo visível."""
+    n_dias = (fim - ini).days + 1
+    if n_dias <= max_pontos:
+        return "D"
+    if n_dias / 7 <= max_pontos:
+        return "W"
+    return "M"
+
+def serie_tendencia(agregados, ini, fim, series, max_pontos=TENDENCIA_MAX_PONTOS):
+    """
+    Recorta as séries pedidas no intervalo visível, na resolução escolhida.
+    Retorna (resolução, {serie: DataFrame[Periodo, Soma, Min, Max, Dias, Media]}).
+    Baldes semanais/mensais das pontas são inteiros (não cortados no intervalo).
+    """
+    res = escolher_resolucao(ini, fim, max_pontos)
+    nivel = agregados["niveis"][res]
+
+    # Início do balde que contém `ini`
+    inicio = pd.Timestamp(ini)
+    if res == "W":
+        inicio -= pd.Timedelta(days=inicio.weekday())
+    elif res == "M":
+        inicio = inicio.replace(day=1)
+    recorte = slice(inicio, pd.Timestamp(fim))
+
+    resultado = {}
+    for nome in series:
+        if nome not in nivel["soma"].columns:
+            continue
+        s = pd.DataFrame({
+            "Soma": nivel["soma"].loc[recorte, nome],
+            "Min": nivel["min"].loc[recorte, nome],
+            "Max": nivel["max"].loc[recorte, nome],
+            "Dias": nivel["dias"].loc[recorte, nome],
+        })
+        s["Media"] = s["Soma"] / s["Dias"].clip(lower=1)
+        resultado[nome] = s.rename_axis("Periodo").reset_index()
+    return res, resultado
+
+
+# ------------------------------------------
+# CÁLCULO COMPLETO DE UM RERUN (BENCHMARK)
+# ------------------------------------------
+def computar_painel(registros, hoje, sem_copias=False):
+    """
+    Todos os cálculos de dados de um rerun do painel, na mesma ordem do dashboard
+    (sem Streamlit e sem cache). Retorna os números exibidos, para comparar modos.
+    """
+    df = montar_df(registros, sem_copias)
+    if df.empty:
+        return {}
+
+    indice = indice_periodos(df, None)
+    mes_atual_start = hoje.replace(day=1)
+    mes_passado_end = mes_atual_start - timedelta(days=1)
+    mes_passado_start = mes_passado_end.replace(day=1)
+
+    grp_atual, grp_anterior, ranking_filial = agrupar_comparativo(
+        df, mes_atual_start, mes_passado_start, mes_passado_end, sem_copias
+    )
+    top_cli = df.groupby("Pagador")["Valor_Total_Frete"].sum().nlargest(5)
+    previsao = projetar_faturamento(df, None, hoje)
+    tendencia = agregados_tendencia(df, None)
+    busca = indice_busca(registros, None)
+
+    return {
+        "hoje": soma_periodo(indice, hoje, hoje),
+        "mes_atual": soma_periodo(indice, mes_atual_start, hoje),
+        "mes_passado": soma_periodo(indice, mes_passado_start, mes_passado_end),
+        "ano": soma_periodo(indice, hoje.replace(month=1, day=1), hoje.replace(month=12, day=31)),
+        "dias_atual": round(float(grp_atual["Valor_Total_Frete"].sum()), 2),
+        "dias_anterior": round(float(grp_anterior["Valor_Total_Frete"].sum()), 2),
+        "filiais": round(float(ranking_filial["Valor_Total_Frete"].sum()), 2),
+        "top_clientes": round(float(top_cli.sum()), 2),
+        "previsao": round(previsao["total"], 2),
+        "tendencia": round(float(tendencia["niveis"]["M"]["soma"]["Todas"].sum()), 2),
+        "busca": len(busca["base"]),
+    }